@@ -1,3 +1,13 @@
+from functools import lru_cache
+import sys
+
+try:
+    import termios
+    import tty
+except ImportError:  # not POSIX
+    termios = None
+
+
 __all__ = [
     "ask_yn",
     "html_color_block",
@@ -21,11 +31,13 @@ def select(msg, options):
         idx, opt = 0, options[0]
         print(f"Choosing {idx: 3d}: {opt}")
     else:
-        for i, opt in enumerate(options):
-            print(f"{i: 3d}: {opt}")
+        sys.stdout.write("".join(f"{i: 3d}: {opt}\n" for i, opt in enumerate(options)))
 
         while True:
-            idx = int(input(f"{msg}: "))
+            try:
+                idx = int(input(f"{msg}: "))
+            except ValueError:
+                continue
             if idx >= 0 and idx < len(options):
                 break
 
@@ -34,6 +46,7 @@ def select(msg, options):
     return idx, opt
 
 
+@lru_cache(maxsize=256)
 def html_color_block(color, size=5):
     """
     """
@@ -41,12 +54,37 @@ def html_color_block(color, size=5):
     r = int(c[0:2], 16)
     g = int(c[2:4], 16)
     b = int(c[4:6], 16)
-    set_fg = f"\033[38;2;{r};{g};{b}m"
-    reset = "\033[0m"
-    return set_fg + "█" * size + reset
+    return f"\033[38;2;{r};{g};{b}m{'█' * size}\033[0m"
+
+
+def _read_char():
+    """
+    Read a single character from stdin without waiting for Enter.
+    """
+    fd = sys.stdin.fileno()
+    old = termios.tcgetattr(fd)
+    try:
+        tty.setcbreak(fd)
+        return sys.stdin.read(1)
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, old)
 
 
 def ask_yn(msg):
+    if termios is not None and sys.stdin.isatty():
+        print(msg + " [y/n]", end="", flush=True)
+        while True:
+            answer = _read_char().lower()
+            if not answer:
+                raise EOFError
+            if answer in ["y", "n"]:
+                print(answer)
+                return answer == "y"
+            if answer not in ["\r", "\n"]:
+                print()
+                print("Please press y or n!")
+                print(msg + " [y/n]", end="", flush=True)
+
     while True:
         answer = input(msg + " [y/n]")
         answer = answer.strip().lower()
@@ -4,21 +4,53 @@ import os
 import click
 from collections import defaultdict
 from dataclasses import dataclass
+from functools import lru_cache
+import itertools
 import json
 import logging
 from pathlib import Path
-import re
 import shutil
 import sqlite3
 import subprocess
+import sys
 import tempfile
-from typing import List, Literal, Optional, Self, Sequence, Tuple, Union
+from typing import Dict, List, Literal, Optional, Self, Sequence, Tuple, Union
 
 import pikepdf
 
 from cli import ask_yn, html_color_block, select
 
 
+_DATA_PATH = Path("~/Zotero").expanduser()
+_ZOTERO_DB_PATH = _DATA_PATH / "zotero.sqlite"
+_BBT_DB_PATH = _DATA_PATH / "better-bibtex.sqlite"
+_STORAGE_PATH = _DATA_PATH / "storage"
+
+_DEFAULT_RGB = (-1.0, -1.0, -1.0)
+
+_N_ANNOTS = pikepdf.Name.Annots
+_N_CONTENTS = pikepdf.Name.Contents
+_N_C = pikepdf.Name.C
+
+# Cite key -> (itemID, path, key) of the PDF attachments
+_ATTACHMENTS_SQL = """
+SELECT ia.itemID, ia.path, att.key
+FROM betterbibtex.citationkey ck
+JOIN items i ON i.key = ck.itemKey
+JOIN itemAttachments ia ON ia.parentItemID = i.itemID
+JOIN items att ON att.itemID = ia.itemID
+WHERE ck.citationkey = ?
+AND ia.contentType = 'application/pdf'
+"""
+
+# Attachment item ID -> annotations
+_ANNOTATIONS_SQL = """
+SELECT text, comment, color, position
+FROM itemAnnotations
+WHERE parentItemID = ?
+"""
+
+
 # Problem: Zotero annotations are not stored to PDF (which is a good thing!),
 # so this can't work without exporting the PDF; which is annoying.
 # -> should really write a Zotero plugin using pdf.js instead
@@ -28,19 +60,17 @@ def list_annotations(pdf: pikepdf.Pdf):
     all_annots = defaultdict(list)
 
     for page in pdf.pages:
-        try:
-            # print(page["/Annots"])
-            # print(page["/Annots"].__dir__())
-            for annot in page["/Annots"]:
-                # print("/T:", repr(annot["/T"]))
-                try:
-                    content = str(annot.get("/Contents", "empty"))
-                    rgb = tuple(float(c) for c in annot.get("/C", [-1, -1, -1]))
-                    all_annots[rgb].append(content)
-                except KeyError:
-                    pass
-        except KeyError:
-            pass
+        # print(page["/Annots"])
+        # print(page["/Annots"].__dir__())
+        annots = page.get(_N_ANNOTS)
+        if annots is None:
+            continue
+
+        for annot in annots:
+            # print("/T:", repr(annot["/T"]))
+            content = str(annot.get(_N_CONTENTS, "empty"))
+            rgb = tuple(map(float, annot.get(_N_C, _DEFAULT_RGB)))
+            all_annots[rgb].append(content)
 
     for col, cont in all_annots.items():
         print(col)
@@ -60,7 +90,17 @@ def list_pdf_annotations(path: Union[str, Path]):
         list_annotations(pdf)
 
 
-@dataclass
+# Maps the (object number, generation) of page objects to their page number
+PageIndex = Dict[Tuple[int, int], int]
+
+
+def build_page_index(pdf: pikepdf.Pdf) -> PageIndex:
+    # `pikepdf.Page(obj).index` searches the whole page tree, which is
+    # quadratic when resolving an entire outline
+    return {page.obj.objgen: idx for idx, page in enumerate(pdf.pages)}
+
+
+@dataclass(slots=True, eq=False)
 class Annotation:
     text: str
     comment: Optional[str]
@@ -72,31 +112,39 @@ class Annotation:
     top: float
 
     @classmethod
-    def parse(
+    def parse_many(
         cls,
-        text: str,
-        comment: Optional[str],
-        color: str,
-        position_json: str,
-    ) -> Self:
-        position = json.loads(position_json)
-        return cls(
-            text=text,
-            comment=comment,
-            color=color,
-            page=position["pageIndex"],
-            left=position["rects"][0][0],
-            bottom=position["rects"][0][1],
-            right=position["rects"][0][2],
-            top=position["rects"][0][3],
-        )
+        rows: Sequence[Tuple[str, Optional[str], str, str]],
+    ) -> List[Self]:
+        """
+        Parse (text, comment, color, position_json) database rows.
+
+        All positions are decoded with a single `json.loads` call.
+        """
+        positions = json.loads("[" + ",".join(row[3] for row in rows) + "]")
+
+        result = []
+        for (text, comment, color, _), position in zip(rows, positions):
+            left, bottom, right, top = position["rects"][0]
+            result.append(cls(
+                text=text,
+                comment=comment,
+                color=color,
+                page=position["pageIndex"],
+                left=left,
+                bottom=bottom,
+                right=right,
+                top=top,
+            ))
+
+        return result
 
     def position_key(self):
         # FIXME: Add an ordering mode that tries to deal with two-column pdfs
         return self.page, -self.top, self.left
 
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class Item:
     level: int
     title: str
@@ -123,13 +171,13 @@ class Item:
         )
 
     @classmethod
-    def from_pikepdf(cls, obj: pikepdf.OutlineItem, level: int = 0) -> Self:
+    def from_pikepdf(cls, obj: pikepdf.OutlineItem, page_index: PageIndex, level: int = 0) -> Self:
         # FIXME: Properly parse destination (important to get decent sorting
         # when combining new and old outline items)
         return cls(
             level=level,
             title=obj.title,
-            page=pikepdf.Page(obj.destination[0]).index,
+            page=page_index[obj.destination[0].objgen],
             top=None,
             left=None,
             source="pdf",
@@ -162,187 +210,239 @@ class Item:
         )
 
 
-def edit_outline(items: List[Item]) -> List[Item]:
-    items_orig = items[:]
+def validate_outline_levels(items: Sequence[Item]) -> Optional[int]:
+    """
+    Return the index of the first item that skips a nesting level, if any.
+    """
+    prev_level = -1
+    for idx, item in enumerate(items):
+        if item.level > prev_level + 1:
+            return idx
+        prev_level = item.level
+
+    return None
 
+
+def edit_outline(items: List[Item]) -> List[Item]:
     while True:
+        # ids in the editor file refer to the items as written in this round
+        items_orig = items[:]
+        ids = list(range(len(items)))
+
         with tempfile.NamedTemporaryFile("w+", suffix=".md") as f:
-            f.writelines((
-                "=" * (item.level + 1) + f" {item.title}  [p. {item.page}, {item.source}, id={id_}]\n"
+            lines = [
+                "=" * (item.level + 1) + f" {item.title}  [p. {item.page}, {item.source}, id={id_}]"
                 for id_, item in enumerate(items)
-            ))
+            ]
+            f.write("".join([line + "\n" for line in lines]))
             f.file.close()
 
             # FIXME: Check whether executable, otherwise have some fallback
             # options (nano, xdg-open)
             editor = os.environ.get("EDITOR", "vim")
-            subprocess.run([editor, f.name])
-
-            items = []
-            with open(f.name) as fres:
-                for line in fres:
-                    header_prefix, text = line.split(" ", maxsplit=1)
-
-                    level = len(header_prefix) - 1
-                    assert header_prefix == "=" * (level + 1)
-
-                    title, meta = text.rsplit("[", maxsplit=1)
-                    title = title.removesuffix(" ")
-                    meta = meta.removesuffix("]")
-                    id_ = None
-                    for m in meta.split(","):
-                        m = m.strip()
-                        match = re.match("id=([0-9]+)", m)
-                        if match:
-                            id_ = int(match.group(1))
-                    assert id_ is not None
-
-
-                    # support reordering + deletion by building a new list here
-                    item = items_orig[id_]
-                    # Use new title and level, might be modified
-                    item.update(level=level, title=title)
-                    items.append(item)
 
-        print_outline(items)
+            while True:
+                st = os.stat(f.name)
+                before = (st.st_mtime_ns, st.st_size)
+                subprocess.run([editor, f.name])
+
+                # Nothing to re-parse if the file wasn't saved, `items`, `ids`
+                # and `lines` are still up-to-date (mtime alone may have too
+                # coarse a granularity to detect a quick save)
+                st = os.stat(f.name)
+                if (st.st_mtime_ns, st.st_size) != before:
+                    lines = Path(f.name).read_text().splitlines()
+
+                    items = []
+                    ids = []
+                    for line in lines:
+                        if line.startswith("#"):
+                            # Error markers from a previous round
+                            continue
+
+                        header_prefix, text = line.split(" ", maxsplit=1)
+
+                        level = len(header_prefix) - 1
+                        assert header_prefix == "=" * (level + 1)
+
+                        title, meta = text.rsplit("[", maxsplit=1)
+                        title = title.removesuffix(" ")
+                        meta = meta.rstrip().removesuffix("]")
+                        id_idx = meta.rfind("id=")
+                        assert id_idx >= 0
+                        id_ = int(meta[id_idx + 3:].split(",", maxsplit=1)[0].strip())
+
+
+                        # support reordering + deletion by building a new list here
+                        item = items_orig[id_]
+                        # Use new title and level, might be modified
+                        item.update(level=level, title=title)
+                        items.append(item)
+                        ids.append(id_)
+
+                # Validate outline nesting here, rather than failing late in
+                # build_pikepdf_outline and losing all edits
+                invalid_idx = validate_outline_levels(items)
+                if invalid_idx is None:
+                    break
+
+                print(f"Invalid outline: {items[invalid_idx].title!r} skips a level")
+                text = "".join(
+                    line + "\n" for line in lines if not line.startswith("#")
+                )
+                Path(f.name).write_text(
+                    f"# ERROR at id={ids[invalid_idx]}: skipped a nesting level\n" + text
+                )
 
-        # FIXME: Validate outline nesting here (to avoid late failure in
-        # build_pikepdf_outline)
+        print_outline(items)
 
         if not ask_yn("Keep editing?"):
             return items
 
 
-def build_pikepdf_outline(items: List[Item], out=None, level=0) -> List[pikepdf.OutlineItem]:
-    if out is None:
-        out = []
-
-    while items:
-        item = items[0]
-        if item.level == level:
-            # Append items at the current level
-            items.pop(0)
-            out.append(item.obj)
-        elif item.level == level + 1:
-            # Higher nesting, recurse
-            children = build_pikepdf_outline(items, None, level + 1)
-            out[-1].children.extend(children)
-        elif item.level < level:
-            # Back to lower nesting
-            return out
-        else:  # item.level >= level + 2
+def build_pikepdf_outline(items: List[Item]) -> List[pikepdf.OutlineItem]:
+    out = []
+    # Frames of (level, children list) from the root down to the most
+    # recently appended item
+    stack = [(-1, out)]
+
+    for item in items:
+        # Back to lower nesting
+        while stack[-1][0] >= item.level:
+            stack.pop()
+
+        if item.level != stack[-1][0] + 1:
             # Skipped a level
             # FIXME: handle the error case in a user-friendly way
             raise RuntimeError("invalid outline levels")
 
+        obj = item.obj
+        # Items from an existing outline still hold their original children,
+        # which will be re-added as far as they were kept
+        obj.children.clear()
+        stack[-1][1].append(obj)
+        stack.append((item.level, obj.children))
+
     return out
 
 
+@lru_cache(maxsize=1)
+def _connection() -> sqlite3.Connection:
+    """
+    Open (once per process) a read-only connection to the Zotero database,
+    with the Better BibTeX database attached as `betterbibtex`.
+    """
+    # Open in autocommit mode to avoid implicit transactions around our
+    # read-only queries. Don't use `immutable=1`: keeping SQLite's locking is
+    # what makes us fail cleanly (rather than reading stale or inconsistent
+    # data) if Zotero is running.
+    con = sqlite3.connect(
+        f'file:{_ZOTERO_DB_PATH}?mode=ro',
+        uri=True,
+        isolation_level=None,
+        cached_statements=512,
+    )
+    # https://github.com/retorquere/zotero-better-bibtex/issues/2684#issuecomment-1774151488
+    con.execute(f'ATTACH DATABASE "file:{_BBT_DB_PATH}?mode=ro" AS betterbibtex')
+
+    con.executescript(
+        """PRAGMA query_only=1;
+        PRAGMA cache_size=-20000;
+        PRAGMA mmap_size=268435456;
+        PRAGMA betterbibtex.cache_size=-20000;
+        PRAGMA betterbibtex.mmap_size=268435456;
+        PRAGMA temp_store=MEMORY;
+        """
+    )
+
+    return con
+
+
 def fetch_zotero_data(cite_key: str) -> Tuple[List[Annotation], Path]:
-    data_path = Path("~/Zotero").expanduser()
+    con = _connection()
 
-    zotero_db_path = data_path / "zotero.sqlite"
-    con = sqlite3.connect(f'file:{zotero_db_path}?mode=ro', uri=True)
-    bbt_db_path = data_path / "better-bibtex.sqlite"
-    # https://github.com/retorquere/zotero-better-bibtex/issues/2684#issuecomment-1774151488
-    con.execute(f'ATTACH DATABASE "file:{bbt_db_path}?mode=ro" AS betterbibtex')
-
-    cur = con.cursor()
-
-    # use bbt database to map cite key to Zotero item key
-    itemKey, libraryID = cur.execute(
-        """SELECT itemKey, libraryID
-        FROM betterbibtex.citationkey
-        WHERE citationkey = ?
-        """,
-        (cite_key,),
-    ).fetchone()
-    print(f"{itemKey=}, {libraryID=}")
-
-    # items: itemID WHERE key = itemKey
-    itemID = cur.execute(
-        """SELECT itemID
-        FROM items
-        WHERE key = ?
-        """,
-        (itemKey,),
-    ).fetchone()[0]
-    print(f"{itemID=}")
-
-    # itemAttachments: itemID as attachmentID WHERE parentItemID = itemID
-    attachments = cur.execute(
-        """SELECT itemID as id, path
-        FROM itemAttachments
-        WHERE parentItemID = ?
-        AND contentType == "application/pdf"
-        """,
-        (itemID,),
-    ).fetchall()
+    # use bbt database to map cite key to Zotero item key, and resolve that
+    # to the item's PDF attachments (including their own item key) in one go
+    attachments = con.execute(_ATTACHMENTS_SQL, (cite_key,)).fetchall()
     print(f"{attachments=}")
 
     idx, _ = select(
         "Choose attachment",
-        [f"{id_}: {path}" for (id_, path) in attachments],
+        [f"{id_}: {path}" for (id_, path, _) in attachments],
     )
-    attachmentID, attachmentPath = attachments[idx]
-
-    attachment_key = cur.execute(
-        """SELECT key
-        FROM items
-        WHERE itemID = ?
-        """,
-        (attachmentID,),
-    ).fetchone()[0]
+    attachmentID, attachmentPath, attachment_key = attachments[idx]
     print(f"{attachment_key=}")
 
     # itemAnnotations: * WHERE parentItemID = attachmentID
-    annotations = cur.execute(
-        """SELECT text, comment, color, position
-        FROM itemAnnotations
-        WHERE parentItemID = ?
-        """,
-        (attachmentID,),
-    ).fetchall()
+    cur = con.execute(_ANNOTATIONS_SQL, (attachmentID,))
 
-    annotations = [Annotation.parse(*a) for a in annotations]
+    # Parse in batches rather than materializing all raw rows first
+    cur.arraysize = 256
+    annotations = []
+    while rows := cur.fetchmany():
+        annotations.extend(Annotation.parse_many(rows))
 
     # Locate the attachment file
     attachment_name = attachmentPath.removeprefix("storage:")
-    attachment_path = data_path / "storage" / attachment_key / attachment_name
+    attachment_path = _STORAGE_PATH / attachment_key / attachment_name
 
     return annotations, attachment_path
 
 
-def print_pikepdf_outline(items: List[pikepdf.OutlineItem], level: int = 0):
-    if level == 0:
-        print("=" * 40)
+def _format_pikepdf_outline(
+    items: List[pikepdf.OutlineItem],
+    page_index: PageIndex,
+    level: int = 0,
+) -> List[str]:
+    lines = []
 
     for item in items:
-        print("\t" * level + f"{item.title} [p. {pikepdf.Page(item.destination[0]).index} ({item.destination[1]})]")
-        print_pikepdf_outline(item.children, level + 1)
+        lines.append("\t" * level + f"{item.title} [p. {page_index[item.destination[0].objgen]} ({item.destination[1]})]\n")
+        lines.extend(_format_pikepdf_outline(item.children, page_index, level + 1))
+
+    return lines
 
+
+def print_pikepdf_outline(
+    items: List[pikepdf.OutlineItem],
+    page_index: PageIndex,
+    level: int = 0,
+):
+    out = _format_pikepdf_outline(items, page_index, level)
     if level == 0:
-        print("=" * 40)
+        out = ["=" * 40 + "\n", *out, "=" * 40 + "\n"]
+
+    sys.stdout.write("".join(out))
 
 
 def print_outline(items: Sequence[Item], level: int = 0):
+    out = []
     if level == 0:
-        print("=" * 40)
+        out.append("=" * 40 + "\n")
 
-    for item in items:
-        print("\t" * item.level + f"{item.title} [p. {item.page}]")
+    out.extend("\t" * item.level + f"{item.title} [p. {item.page}]\n" for item in items)
 
     if level == 0:
-        print("=" * 40)
+        out.append("=" * 40 + "\n")
+
+    sys.stdout.write("".join(out))
 
 
-def parse_pikepdf_outline(items: Sequence[pikepdf.OutlineItem], level: int = 0) -> List[Item]:
+def parse_pikepdf_outline(
+    items: Sequence[pikepdf.OutlineItem],
+    page_index: PageIndex,
+    level: int = 0,
+) -> List[Item]:
     result = []
 
-    for item in items:
-        result.append(Item.from_pikepdf(item, level=level))
-        result.extend(parse_pikepdf_outline(item.children, level=level + 1))
-        
+    # Pre-order traversal: push children in reverse such that they are
+    # popped in document order
+    stack = [(item, level) for item in reversed(items)]
+    while stack:
+        item, level = stack.pop()
+        result.append(Item.from_pikepdf(item, page_index, level=level))
+        stack.extend((child, level + 1) for child in reversed(item.children))
+
     return result
 
 
@@ -350,48 +450,52 @@ def parse_pikepdf_outline(items: Sequence[pikepdf.OutlineItem], level: int = 0)
 @click.argument("cite-key")
 def outline_from_annotations(cite_key: str):
     annotations, attachment_path = fetch_zotero_data(cite_key)
-    annotations = sorted(annotations, key=Annotation.position_key)
+    # Sort by color first, such that annotations can be grouped in one pass,
+    # and by position within each color
+    annotations = sorted(annotations, key=lambda a: (a.color, *a.position_key()))
 
     # Ask user to select annotations for a specific color
-    annotations_by_color = defaultdict(list)
-    for annot in annotations:
-        annotations_by_color[annot.color].append(annot)
+    annotations_by_color = {
+        color: list(annots)
+        for color, annots in itertools.groupby(annotations, key=lambda a: a.color)
+    }
 
     options = []
+    colors = []
     for color, annots in annotations_by_color.items():
         opt = f"Color: {html_color_block(color)}\n"
         opt += "\n".join([str(a) for a in annots])
         opt += "\n"
         options.append(opt)
+        colors.append(color)
 
     color_idx, _ = select("Choose annotation color", options)
-    annotations = annotations_by_color[list(annotations_by_color.keys())[color_idx]]
+    annotations = annotations_by_color[colors[color_idx]]
 
     items = [Item.from_annotation(a) for a in annotations]
 
+    # Keep the PDF open across editing: parsing it is by far the most
+    # expensive step, and this way existing outline items stay attached to it
     with pikepdf.open(attachment_path) as pdf:
         with pdf.open_outline() as outline:
             if outline.root:
+                page_index = build_page_index(pdf)
                 print("Attachment already contains an outline:")
-                print_pikepdf_outline(outline.root)
-                clear_outline = not ask_yn("Keep these entries?")
-                if not clear_outline:
-                    items.extend(parse_pikepdf_outline(outline.root))
+                print_pikepdf_outline(outline.root, page_index)
+                if ask_yn("Keep these entries?"):
+                    items.extend(parse_pikepdf_outline(outline.root, page_index))
                     items = sorted(items, key=Item.position_key)
-            else:
-                clear_outline = False
 
-    items = edit_outline(items)
+        items = edit_outline(items)
 
-    # Convert flat `Item` list into `OutlineItem` tree
-    outline_items = build_pikepdf_outline(items)
-    logging.debug(outline_items)
+        # Convert flat `Item` list into `OutlineItem` tree
+        outline_items = build_pikepdf_outline(items)
+        logging.debug(outline_items)
 
-    # Add outline to PDF and write to a temporary file
-    with pikepdf.open(attachment_path) as pdf:
+        # Add outline to PDF and write to a temporary file. Entries of the
+        # original outline that were kept are part of `outline_items`.
         with pdf.open_outline() as outline:
-            if clear_outline:
-                outline.root.clear()
+            outline.root.clear()
             outline.root.extend(outline_items)
 
         with tempfile.NamedTemporaryFile(
@@ -399,22 +503,24 @@ def outline_from_annotations(cite_key: str):
             suffix=".pdf",
         ) as dest:
             print(dest.name)
-            pdf.save(dest.file)
+            pdf.save(dest.file, fix_metadata_version=False)
             dest.file.close()
 
+            # Wait for xdg-open: `dest` is deleted or moved as soon as the
+            # prompt below is answered, and a terminal viewer would compete
+            # with the prompt for the tty
             subprocess.run(["xdg-open", dest.name])
     
-            # TODO: Atomically copy to the original location, be sure to update mtime
             replace = ask_yn("Replace original file?")
             if replace:
                 bak_path = attachment_path.with_name(attachment_path.name + ".bak")
-                shutil.move(attachment_path, bak_path)
-                shutil.move(dest.name, attachment_path)
+                # `dest` lives in the same directory, so these are plain
+                # renames (and the latter is atomic)
+                os.rename(attachment_path, bak_path)
+                os.replace(dest.name, attachment_path)
                 dest.delete_on_close = False
-                try:
+                if shutil.which("trash-put"):
                     subprocess.run(["trash-put", bak_path])
-                except Exception:
-                    pass
 
 
 